@@ -1,6 +1,13 @@
+import platform
 from pathlib import Path
 from pydantic_settings import BaseSettings
 
+# INT8 exports shipped with sentence-transformers models, one per CPU family
+if platform.machine().lower() in ("arm64", "aarch64"):
+    _DEFAULT_ONNX_FILE = "onnx/model_qint8_arm64.onnx"
+else:
+    _DEFAULT_ONNX_FILE = "onnx/model_quint8_avx2.onnx"
+
 
 class Settings(BaseSettings):
     # Paths
@@ -8,21 +15,76 @@ class Settings(BaseSettings):
     data_dir: Path = base_dir / "data"
     documents_dir: Path = data_dir / "documents"
     embeddings_dir: Path = data_dir / "embeddings"
+    chunk_db_path: Path = data_dir / "chunks.db"
+
+    # Local model inference
+    ml_threads: int = 0  # Torch intra-op threads for local models (0 = library default)
+    ml_workers: int = 3  # Threads for CPU-bound chunking/embedding calls
+
+    prewarm_models: bool = True  # Warm Ollama and Whisper at startup, not on first request
 
     # Whisper settings
-    whisper_model: str = "base"  # tiny, base, small, medium, large
+    # Options: tiny, base, small, medium, large-v3, distil-small.en, distil-large-v3.
+    # distil-small.en is the accuracy upgrade over base (12-layer encoder, ~166M
+    # params vs 6 layers/74M), so it is slower per short clip on CPU.
+    whisper_model: str = "base"
+    whisper_language: str = "en"  # Empty = detect per clip (an extra encoder pass)
+    whisper_beam_size: int = 1  # 1 = greedy decoding; raise for accuracy over latency
+    whisper_vad_filter: bool = True  # Silero VAD skips silence before decoding
+    whisper_device: str = "auto"  # cpu, cuda or auto
+    # auto lets CTranslate2 pick the fastest type for the hardware (int8 on CPU,
+    # int8_float16 on GPU)
+    whisper_compute_type: str = "auto"
+    whisper_cpu_threads: int = 0  # 0 = one per physical core (logical cores / 2)
+    whisper_local_files_only: bool = False  # Skip the hub check once the model is cached
 
     # Embedding settings
     embedding_model: str = "all-MiniLM-L6-v2"
+    embedding_backend: str = "onnx"  # onnx (ONNX Runtime) or torch
+    embedding_onnx_file: str = _DEFAULT_ONNX_FILE  # INT8 dynamic-quantized export for this CPU
     chunk_size: int = 1024  # Larger chunks for complete claims
     chunk_overlap: int = 50
+    embedding_batch_size: int = 64  # Micro-batch size for SentenceTransformer.encode
+    query_cache_size: int = 256  # Recent query embeddings kept in memory
+
+    # Vector index settings
+    # sq_fp16 (half-precision codes), flat (exact fp32), hnsw (graph, rebuild on delete)
+    # or pq (product-quantized)
+    index_type: str = "sq_fp16"
+    hnsw_m: int = 32  # Neighbours per node
+    hnsw_ef_construction: int = 200
+    hnsw_ef_search: int = 64
+    pq_m: int = 48  # Sub-quantizers; must divide the embedding dimension
+    pq_nbits: int = 8  # Bits per sub-quantizer code
+    pq_train_min: int = 10000  # Vectors needed before switching flat -> PQ
+    index_save_interval: float = 5.0  # Seconds between background index flushes
 
     # RAG settings
     top_k: int = 5  # Retrieve more chunks for better coverage
+    # Skip the LLM when even the best hit is this far away (squared L2 on unit
+    # vectors, 0-4; 1.5 ~ cosine 0.25)
+    rag_llm_skip_distance: float = 1.5
+    rag_llm_min_context: int = 50  # Skip the LLM for shorter contexts
 
     # Ollama settings
     ollama_base_url: str = "http://localhost:11434"
+    # The library's gemma3:4b is the Q4_K_M build; avoid fp16/bf16 tags, which
+    # are ~3.5x slower to decode
     ollama_model: str = "gemma3:4b"
+    # Router model; a quantized tag (e.g. ":270m-it-q8_0") cuts memory traffic vs fp16/fp32
+    router_model: str = "functiongemma"
+    router_cache_size: int = 1024  # Recent routing decisions kept in memory
+    # Keep models resident between requests. A Go duration with a unit: "24h",
+    # or "-1m" for forever (a bare "-1" is rejected as "missing unit in duration")
+    ollama_keep_alive: str = "30m"
+    ollama_num_gpu: int = -1  # Layers to offload to GPU (-1 = let Ollama decide)
+    ollama_num_batch: int = 2048  # Prompt-processing batch size (Ollama default 512)
+    ollama_num_thread: int = 0  # CPU threads for inference (0 = Ollama's physical-core default)
+
+    # Vision settings
+    vision_max_image_size: int = 896  # Longest side sent to Gemma 3 (its native resolution)
+    vision_max_concurrency: int = 2  # Vision generations in flight to Ollama at once
+    vision_cache_size: int = 64  # Recent (image, question) answers kept in memory
 
     class Config:
         env_prefix = "RAG_"
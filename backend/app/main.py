@@ -1,28 +1,73 @@
+import asyncio
+import importlib.util
+import os
 from contextlib import asynccontextmanager
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 
+from app.config import settings
+
+# First-run model pulls (embedding, whisper, chunker) go through huggingface_hub;
+# hf_transfer fetches each file with parallel range requests. Must be set before
+# huggingface_hub is imported, and only when installed or it refuses to download.
+if importlib.util.find_spec("hf_transfer") is not None:
+    os.environ.setdefault("HF_HUB_ENABLE_HF_TRANSFER", "1")
+
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     """Load ML models at startup."""
     print("Starting up - loading models...")
 
-    # Load embedding model
-    from app.services.embedding_service import get_embedding_service
-    get_embedding_service()
+    loop = asyncio.get_running_loop()
+    # uvicorn's default loop="auto" runs on uvloop whenever it is installed
+    print(f"Event loop: {type(loop).__module__}.{type(loop).__name__}")
 
-    # Load whisper model
+    from app.services.embedding_service import get_embedding_service
     from app.services.whisper_service import get_whisper_service
-    get_whisper_service()
-
-    # Load NeuralChunker (BERT model for topic-based chunking)
     from app.services.document_service import get_chunker
-    get_chunker()
+    from app.services.llm_service import get_llm_service
+    from app.services.router_service import get_router_service
+    from app.services.vision_service import get_vision_service
+    from app.services.ml_executor import shutdown_ml_executor
+
+    # Have Ollama load the chat and router models while local models load, so
+    # the first query doesn't pay for it. Failures only log; lazy load remains.
+    prewarm = (
+        [get_llm_service().warmup(), get_router_service().warmup()]
+        if settings.prewarm_models
+        else []
+    )
+
+    # Load embedding, whisper and NeuralChunker (topic-based chunking) models in
+    # parallel - weight loading and init overlap across threads
+    results = await asyncio.gather(
+        asyncio.to_thread(get_embedding_service),
+        asyncio.to_thread(get_whisper_service),
+        asyncio.to_thread(get_chunker),
+        *prewarm,
+    )
+    embedding_service = results[0]
 
     print("All models loaded successfully!")
+
+    # Persist index changes in the background instead of on every request
+    autosave_task = asyncio.create_task(embedding_service.run_autosave())
+
     yield
+
     print("Shutting down...")
+    autosave_task.cancel()
+    try:
+        await autosave_task
+    except asyncio.CancelledError:
+        pass
+    embedding_service.flush()
+
+    await get_llm_service().aclose()
+    await get_router_service().aclose()
+    await get_vision_service().aclose()
+    shutdown_ml_executor()
 
 
 app = FastAPI(
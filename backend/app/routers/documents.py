@@ -8,6 +8,7 @@ from app.models.schemas import (
 )
 from app.services import document_service
 from app.services.embedding_service import get_embedding_service
+from app.services.ml_executor import run_ml
 
 router = APIRouter(prefix="/documents", tags=["documents"])
 
@@ -34,13 +35,36 @@ async def upload_document(file: UploadFile = File(...)):
     if not file.filename.endswith(".txt"):
         raise HTTPException(status_code=400, detail="Only .txt files are allowed")
 
-    content = await file.read()
-
-    # Save document and get chunks
-    doc_id, chunks = await document_service.save_document(file.filename, content)
-
-    # Add to embedding index
-    get_embedding_service().add_document_chunks(doc_id, chunks)
+    # Stream to disk in fixed-size reads instead of holding the whole upload
+    upload_path, content_hash, size_bytes = await document_service.receive_upload(file)
+
+    try:
+        # Re-uploads of identical content reuse the existing chunks and embeddings
+        existing = await document_service.find_document_by_hash(content_hash)
+        if existing:
+            upload_path.unlink(missing_ok=True)
+            return DocumentUploadResponse(
+                id=existing.id,
+                filename=existing.filename,
+                message="Document already uploaded, reusing existing index",
+                chunk_count=existing.chunk_count,
+            )
+
+        # Save document and get chunks (cleans up its own files on failure)
+        doc_id, chunks = await document_service.save_document(
+            file.filename, upload_path, content_hash, size_bytes
+        )
+    except BaseException:
+        upload_path.unlink(missing_ok=True)
+        raise
+
+    try:
+        # Add to embedding index (CPU-bound, run on the ML pool)
+        await run_ml(get_embedding_service().add_document_chunks, doc_id, chunks)
+    except BaseException:
+        # Unindexed documents would be found by the hash check but never searched
+        await document_service.delete_document(doc_id)
+        raise
 
     return DocumentUploadResponse(
         id=doc_id,
@@ -58,8 +82,8 @@ async def delete_document(doc_id: str):
     if not doc:
         raise HTTPException(status_code=404, detail="Document not found")
 
-    # Remove from embedding index
-    get_embedding_service().remove_document(doc_id)
+    # Remove from embedding index (an HNSW rebuild is CPU-bound; run on the ML pool)
+    await run_ml(get_embedding_service().remove_document, doc_id)
 
     # Delete document files
     await document_service.delete_document(doc_id)
@@ -1,7 +1,9 @@
+import orjson
 from fastapi import APIRouter
+from fastapi.responses import StreamingResponse
 
 from app.models.schemas import RAGQuery, RAGResult
-from app.services.rag_service import query_rag
+from app.services.rag_service import query_rag, query_rag_stream
 
 router = APIRouter(prefix="/query", tags=["query"])
 
@@ -14,3 +16,17 @@ async def query_documents(request: RAGQuery):
         query=result["query"],
         retrieved_chunks=result["retrieved_chunks"],
     )
+
+
+@router.post("/stream")
+async def query_documents_stream(request: RAGQuery):
+    """Query documents using RAG, streaming the answer as NDJSON events.
+
+    Emits a "chunks" event with the retrieved context first, then one "token"
+    event per generated token, then "done" (or "error").
+    """
+    async def events():
+        async for event in query_rag_stream(request.query, request.top_k):
+            yield orjson.dumps(event) + b"\n"
+
+    return StreamingResponse(events(), media_type="application/x-ndjson")
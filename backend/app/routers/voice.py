@@ -1,6 +1,4 @@
 import json
-import io
-import wave
 from fastapi import APIRouter, WebSocket, WebSocketDisconnect
 
 from app.services.whisper_service import get_whisper_service
@@ -23,7 +21,7 @@ async def voice_websocket(websocket: WebSocket):
     3. Server responds with transcription and RAG results
     """
     await websocket.accept()
-    audio_buffer = io.BytesIO()
+    audio_buffer = bytearray()
     whisper_service = get_whisper_service()
 
     try:
@@ -39,8 +37,8 @@ async def voice_websocket(websocket: WebSocket):
                 data = json.loads(message["text"])
 
                 if data.get("type") == "end":
-                    # Process accumulated audio
-                    audio_data = audio_buffer.getvalue()
+                    # Process accumulated audio (no copy; buffer is cleared after use)
+                    audio_data = audio_buffer
 
                     if len(audio_data) > 0:
                         try:
@@ -51,7 +49,7 @@ async def voice_websocket(websocket: WebSocket):
                             })
 
                             # Transcribe
-                            result = whisper_service.transcribe_wav_bytes(audio_data)
+                            result = await whisper_service.atranscribe_wav_bytes(audio_data)
                             transcription = result["text"]
 
                             # Send transcription
@@ -128,11 +126,11 @@ async def voice_websocket(websocket: WebSocket):
                             })
 
                     # Reset buffer for next recording
-                    audio_buffer = io.BytesIO()
+                    audio_buffer.clear()
 
                 elif data.get("type") == "reset":
                     # Reset buffer
-                    audio_buffer = io.BytesIO()
+                    audio_buffer.clear()
                     await websocket.send_json({
                         "type": "status",
                         "data": {"message": "Buffer reset"}
@@ -173,7 +171,7 @@ async def voice_websocket(websocket: WebSocket):
 
             elif "bytes" in message:
                 # Binary audio data
-                audio_buffer.write(message["bytes"])
+                audio_buffer.extend(message["bytes"])
 
     except WebSocketDisconnect:
         print("WebSocket client disconnected")
@@ -193,6 +191,15 @@ async def voice_stream_websocket(websocket: WebSocket):
     """
     Alternative WebSocket for real-time streaming transcription.
     Processes audio in smaller chunks for faster feedback.
+
+    Protocol:
+    1. Client sends an audio chunk as binary data (WAV format)
+    2. Server sends a {"type": "transcription_segment"} message per decoded
+       segment ({"text", "start", "end"} in seconds) as soon as it is ready
+    3. Server then sends exactly one {"type": "transcription"} message for the
+       chunk with the joined text and "partial": false - also when the chunk
+       was silent and the text is empty
+    4. Client may send JSON {"type": "query", "text": ...} for a RAG result
     """
     await websocket.accept()
     whisper_service = get_whisper_service()
@@ -210,14 +217,22 @@ async def voice_stream_websocket(websocket: WebSocket):
 
                 if len(audio_data) > 0:
                     try:
-                        # Transcribe chunk
-                        result = whisper_service.transcribe_wav_bytes(audio_data)
+                        # Transcribe chunk, sending each segment as soon as it
+                        # is decoded (decoding runs off the event loop)
+                        texts = []
+                        async for segment in whisper_service.atranscribe_wav_bytes_stream(audio_data):
+                            texts.append(segment["text"])
+                            await websocket.send_json({
+                                "type": "transcription_segment",
+                                "data": segment
+                            })
 
+                        # One final reply per chunk, even if nothing was said
                         await websocket.send_json({
                             "type": "transcription",
                             "data": {
-                                "text": result["text"],
-                                "partial": True
+                                "text": " ".join(texts).strip(),
+                                "partial": False
                             }
                         })
                     except Exception as e:
@@ -0,0 +1,115 @@
+import json
+import sqlite3
+import threading
+from typing import Optional
+
+from app.config import settings
+
+# Single shared connection - lazy loaded
+_conn: Optional[sqlite3.Connection] = None
+_lock = threading.Lock()
+
+
+def _migrate_json_chunks(conn: sqlite3.Connection) -> None:
+    """Import legacy per-document {doc_id}_chunks.json files into the store."""
+    known = {row[0] for row in conn.execute("SELECT DISTINCT doc_id FROM chunks")}
+    for chunks_path in settings.documents_dir.glob("*_chunks.json"):
+        doc_id = chunks_path.name[: -len("_chunks.json")]
+        if doc_id in known:
+            continue
+        with open(chunks_path, "r") as f:
+            chunks = json.load(f)
+        conn.executemany(
+            "INSERT OR REPLACE INTO chunks (doc_id, chunk_idx, text) VALUES (?, ?, ?)",
+            [(doc_id, i, text) for i, text in enumerate(chunks)],
+        )
+        print(f"[ChunkStore] Migrated {len(chunks)} chunks for document {doc_id}")
+    conn.commit()
+
+
+def get_connection() -> sqlite3.Connection:
+    """Get or create the shared SQLite connection."""
+    global _conn
+    if _conn is None:
+        with _lock:
+            if _conn is None:
+                conn = sqlite3.connect(settings.chunk_db_path, check_same_thread=False)
+                conn.execute("PRAGMA journal_mode=WAL")
+                conn.execute("PRAGMA synchronous=NORMAL")
+                conn.execute(
+                    """CREATE TABLE IF NOT EXISTS chunks (
+                        doc_id TEXT NOT NULL,
+                        chunk_idx INTEGER NOT NULL,
+                        text TEXT NOT NULL,
+                        PRIMARY KEY (doc_id, chunk_idx)
+                    )"""
+                )
+                _migrate_json_chunks(conn)
+                _conn = conn
+    return _conn
+
+
+def put_chunks(doc_id: str, chunks: list[str]) -> None:
+    """Store all chunks for a document, replacing any existing ones."""
+    conn = get_connection()
+    with _lock:
+        conn.execute("DELETE FROM chunks WHERE doc_id = ?", (doc_id,))
+        conn.executemany(
+            "INSERT INTO chunks (doc_id, chunk_idx, text) VALUES (?, ?, ?)",
+            [(doc_id, i, text) for i, text in enumerate(chunks)],
+        )
+        conn.commit()
+
+
+def get_chunk_texts(keys: list[tuple[str, int]]) -> dict[tuple[str, int], str]:
+    """Fetch many chunks in one query, keyed by (doc_id, chunk_idx)."""
+    if not keys:
+        return {}
+    unique = list(dict.fromkeys(keys))
+    placeholders = ", ".join("(?, ?)" for _ in unique)
+    params = [value for key in unique for value in key]
+    conn = get_connection()
+    with _lock:
+        rows = conn.execute(
+            f"SELECT doc_id, chunk_idx, text FROM chunks "
+            f"WHERE (doc_id, chunk_idx) IN (VALUES {placeholders})",
+            params,
+        ).fetchall()
+    return {(doc_id, chunk_idx): text for doc_id, chunk_idx, text in rows}
+
+
+def get_doc_ids() -> list[str]:
+    """Every document id with stored chunks."""
+    conn = get_connection()
+    with _lock:
+        rows = conn.execute("SELECT DISTINCT doc_id FROM chunks").fetchall()
+    return [row[0] for row in rows]
+
+
+def get_chunks(doc_id: str) -> list[str]:
+    """Get all chunks for a document in order."""
+    conn = get_connection()
+    with _lock:
+        rows = conn.execute(
+            "SELECT text FROM chunks WHERE doc_id = ? ORDER BY chunk_idx",
+            (doc_id,),
+        ).fetchall()
+    return [row[0] for row in rows]
+
+
+def get_all_chunks() -> list[tuple[str, str, int]]:
+    """Get every stored chunk as (doc_id, text, chunk_idx)."""
+    conn = get_connection()
+    with _lock:
+        rows = conn.execute(
+            "SELECT doc_id, chunk_idx, text FROM chunks ORDER BY doc_id, chunk_idx"
+        ).fetchall()
+    return [(doc_id, text, chunk_idx) for doc_id, chunk_idx, text in rows]
+
+
+def delete_chunks(doc_id: str) -> None:
+    """Delete all chunks for a document."""
+    conn = get_connection()
+    with _lock:
+        conn.execute("DELETE FROM chunks WHERE doc_id = ?", (doc_id,))
+        conn.commit()
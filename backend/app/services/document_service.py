@@ -1,7 +1,11 @@
+import asyncio
+import hashlib
 import os
+import threading
 import uuid
-import json
 import aiofiles
+import orjson
+from fastapi import UploadFile
 from pathlib import Path
 from datetime import datetime
 from typing import Optional
@@ -12,25 +16,45 @@ if platform.system() == "Darwin":
     os.environ.setdefault("OMP_NUM_THREADS", "1")
     os.environ.setdefault("MKL_NUM_THREADS", "1")
 
+import torch
 from chonkie import NeuralChunker
 
 from app.config import settings
 from app.models.schemas import DocumentMetadata
+from app.services import chunk_store
+from app.services.ml_executor import run_ml
+
+# Read size when streaming uploads to disk
+UPLOAD_READ_SIZE = 1 << 20
 
 # Lazy-loaded chunker
 _chunker: Optional[NeuralChunker] = None
+_chunker_lock = threading.Lock()
+
+# In-memory copy of metadata.json, written through on every save
+_metadata_cache: Optional[dict] = None
+_metadata_lock = asyncio.Lock()
 
 
 def get_chunker() -> NeuralChunker:
     """Get or create neural chunker for topic detection."""
     global _chunker
     if _chunker is None:
-        print("[Chunker] Initializing NeuralChunker (BERT-based topic detection)")
-        _chunker = NeuralChunker(
-            model="mirth/chonky_modernbert_base_1",
-            device_map="cpu",
-            min_characters_per_chunk=50,
-        )
+        with _chunker_lock:
+            if _chunker is None:
+                print("[Chunker] Initializing NeuralChunker (BERT-based topic detection)")
+                if settings.ml_threads > 0:
+                    torch.set_num_threads(settings.ml_threads)
+                chunker = NeuralChunker(
+                    model="mirth/chonky_modernbert_base_1",
+                    device_map="cpu",
+                    min_characters_per_chunk=50,
+                )
+                # Inference only: make sure dropout etc. are off
+                model = getattr(getattr(chunker, "pipe", None), "model", None)
+                if model is not None:
+                    model.eval()
+                _chunker = chunker
     return _chunker
 
 
@@ -38,25 +62,74 @@ def get_metadata_path() -> Path:
     return settings.embeddings_dir / "metadata.json"
 
 
-async def load_metadata() -> dict:
+async def _read_metadata_file() -> dict:
     path = get_metadata_path()
     if not path.exists():
         return {}
-    async with aiofiles.open(path, "r") as f:
+    async with aiofiles.open(path, "rb") as f:
         content = await f.read()
-        return json.loads(content) if content else {}
+        return orjson.loads(content) if content else {}
+
+
+async def load_metadata() -> dict:
+    """Return the cached metadata dict, reading from disk on first use.
+
+    The dict is shared; callers that modify it must follow with save_metadata.
+    """
+    global _metadata_cache
+    if _metadata_cache is None:
+        async with _metadata_lock:
+            if _metadata_cache is None:
+                _metadata_cache = await _read_metadata_file()
+    return _metadata_cache
 
 
 async def save_metadata(metadata: dict) -> None:
+    """Write metadata to disk and make it the cached copy."""
+    global _metadata_cache
     path = get_metadata_path()
-    async with aiofiles.open(path, "w") as f:
-        await f.write(json.dumps(metadata, default=str, indent=2))
+    async with _metadata_lock:
+        async with aiofiles.open(path, "wb") as f:
+            await f.write(orjson.dumps(metadata, default=str, option=orjson.OPT_INDENT_2))
+        _metadata_cache = metadata
+
+
+async def receive_upload(file: UploadFile) -> tuple[Path, str, int]:
+    """Stream an upload to a temp file, returning (path, content_hash, size_bytes).
+
+    The content hash is used for duplicate detection.
+    """
+    hasher = hashlib.blake2b(digest_size=16)
+    size = 0
+    upload_path = settings.documents_dir / f"{uuid.uuid4()}.upload"
+    try:
+        async with aiofiles.open(upload_path, "wb") as out:
+            while chunk := await file.read(UPLOAD_READ_SIZE):
+                hasher.update(chunk)
+                size += len(chunk)
+                await out.write(chunk)
+    except BaseException:
+        # Includes cancellation when the client disconnects mid-upload
+        upload_path.unlink(missing_ok=True)
+        raise
+    return upload_path, hasher.hexdigest(), size
+
+
+async def find_document_by_hash(content_hash: str) -> Optional[DocumentMetadata]:
+    """Find an already-uploaded document with identical content."""
+    metadata = await load_metadata()
+    for doc in metadata.values():
+        if doc.get("content_hash") == content_hash:
+            return DocumentMetadata(**doc)
+    return None
 
 
 def chunk_text(text: str) -> list[str]:
     """Split text into chunks using neural topic detection."""
     chunker = get_chunker()
-    chunks = chunker(text)
+    # Skip autograd bookkeeping for the BERT forward pass
+    with torch.inference_mode():
+        chunks = chunker(text)
 
     # Extract text and log
     result = [chunk.text.strip() for chunk in chunks if chunk.text.strip()]
@@ -68,23 +141,30 @@ def chunk_text(text: str) -> list[str]:
     return result
 
 
-async def save_document(filename: str, content: bytes) -> tuple[str, list[str]]:
-    """Save document and return doc_id and chunks."""
+async def save_document(
+    filename: str, upload_path: Path, content_hash: str, size_bytes: int
+) -> tuple[str, list[str]]:
+    """Save a received upload as a document and return doc_id and chunks."""
     doc_id = str(uuid.uuid4())
 
-    # Save raw file
+    # Move raw file into place
     file_path = settings.documents_dir / f"{doc_id}.txt"
-    async with aiofiles.open(file_path, "wb") as f:
-        await f.write(content)
-
-    # Chunk the text semantically
-    text = content.decode("utf-8")
-    chunks = chunk_text(text)
-
-    # Save chunks
-    chunks_path = settings.documents_dir / f"{doc_id}_chunks.json"
-    async with aiofiles.open(chunks_path, "w") as f:
-        await f.write(json.dumps(chunks))
+    os.replace(upload_path, file_path)
+
+    try:
+        # Decode bytes ourselves: text mode would rewrite CRLF line endings
+        async with aiofiles.open(file_path, "rb") as f:
+            text = (await f.read()).decode("utf-8")
+        # Chunk the text semantically (CPU-bound BERT pass, keep off the event loop)
+        chunks = await run_ml(chunk_text, text)
+
+        # Save chunks
+        chunk_store.put_chunks(doc_id, chunks)
+    except BaseException:
+        # Don't leave a half-saved document behind (e.g. non-UTF-8 upload)
+        file_path.unlink(missing_ok=True)
+        chunk_store.delete_chunks(doc_id)
+        raise
 
     # Update metadata
     metadata = await load_metadata()
@@ -93,7 +173,8 @@ async def save_document(filename: str, content: bytes) -> tuple[str, list[str]]:
         "filename": filename,
         "uploaded_at": datetime.utcnow().isoformat(),
         "chunk_count": len(chunks),
-        "size_bytes": len(content),
+        "size_bytes": size_bytes,
+        "content_hash": content_hash,
     }
     await save_metadata(metadata)
 
@@ -120,7 +201,7 @@ async def delete_document(doc_id: str) -> bool:
     if doc_id not in metadata:
         return False
 
-    # Delete files
+    # Delete files (and any legacy JSON chunk file)
     file_path = settings.documents_dir / f"{doc_id}.txt"
     chunks_path = settings.documents_dir / f"{doc_id}_chunks.json"
 
@@ -128,6 +209,7 @@ async def delete_document(doc_id: str) -> bool:
         file_path.unlink()
     if chunks_path.exists():
         chunks_path.unlink()
+    chunk_store.delete_chunks(doc_id)
 
     # Remove from metadata
     del metadata[doc_id]
@@ -138,16 +220,8 @@ async def delete_document(doc_id: str) -> bool:
 
 async def get_all_chunks() -> list[tuple[str, str, int]]:
     """Get all chunks with their doc_id and chunk_index."""
-    metadata = await load_metadata()
-    all_chunks = []
-
-    for doc_id in metadata:
-        chunks_path = settings.documents_dir / f"{doc_id}_chunks.json"
-        if chunks_path.exists():
-            async with aiofiles.open(chunks_path, "r") as f:
-                content = await f.read()
-                chunks = json.loads(content)
-                for i, chunk in enumerate(chunks):
-                    all_chunks.append((doc_id, chunk, i))
-
-    return all_chunks
+    # Overlap the metadata read with the chunk scan
+    metadata, all_chunks = await asyncio.gather(
+        load_metadata(), asyncio.to_thread(chunk_store.get_all_chunks)
+    )
+    return [c for c in all_chunks if c[0] in metadata]
@@ -1,4 +1,8 @@
+import asyncio
+import functools
 import json
+import os
+import threading
 import numpy as np
 import faiss
 from pathlib import Path
@@ -6,13 +10,27 @@ from sentence_transformers import SentenceTransformer
 from typing import Optional
 
 from app.config import settings
+from app.services import chunk_store
+
+# Bump when the on-disk index layout or metric changes so stale indexes are rebuilt
+INDEX_VERSION = 5
 
 
 class EmbeddingService:
     _instance: Optional["EmbeddingService"] = None
     _model: Optional[SentenceTransformer] = None
-    _index: Optional[faiss.IndexFlatL2] = None
-    _chunk_map: list[tuple[str, int]] = []  # (doc_id, chunk_index)
+    _index: Optional[faiss.Index] = None
+    # Each document's chunks occupy a contiguous id range: doc_id -> (first id, count).
+    # Chunk i of a document has vector id first + i.
+    _doc_slices: dict[str, tuple[int, int]] = {}
+    # Sorted (first id, doc_id) columns derived from _doc_slices for id -> doc lookup
+    _slice_starts: np.ndarray = np.empty(0, dtype=np.int64)
+    _slice_docs: list[str] = []
+    _next_id: int = 0
+    _dirty: bool = False  # Index changed since last save
+    _training: bool = False  # A PQ training pass is in progress
+    _lock = threading.RLock()  # Guards index/chunk map reads and mutation
+    _save_lock = threading.Lock()  # Serializes writers of the on-disk files
 
     def __new__(cls):
         if cls._instance is None:
@@ -21,46 +39,295 @@ class EmbeddingService:
 
     def __init__(self):
         if self._model is None:
-            print(f"Loading embedding model: {settings.embedding_model}")
-            self._model = SentenceTransformer(settings.embedding_model)
+            print(
+                f"Loading embedding model: {settings.embedding_model} "
+                f"({settings.embedding_backend})"
+            )
+            if settings.embedding_backend == "onnx":
+                # ONNX Runtime with an INT8 quantized export of the same model
+                self._model = SentenceTransformer(
+                    settings.embedding_model,
+                    backend="onnx",
+                    model_kwargs={
+                        "file_name": settings.embedding_onnx_file,
+                        "provider": "CPUExecutionProvider",
+                    },
+                )
+            else:
+                self._model = SentenceTransformer(settings.embedding_model)
+            # Voice queries repeat often; skip the forward pass on cache hits
+            self._embed_query_cached = functools.lru_cache(
+                maxsize=settings.query_cache_size
+            )(self.embed_query)
             self._load_index()
 
     def _get_index_path(self) -> Path:
         return settings.embeddings_dir / "faiss.index"
 
     def _get_map_path(self) -> Path:
+        return settings.embeddings_dir / "chunk_map.npz"
+
+    def _get_legacy_map_path(self) -> Path:
         return settings.embeddings_dir / "chunk_map.json"
 
+    def _set_slices(self, doc_slices: dict[str, tuple[int, int]]) -> None:
+        """Replace the slice map and refresh the sorted lookup columns."""
+        self._doc_slices = doc_slices
+        ordered = sorted(doc_slices.items(), key=lambda item: item[1][0])
+        self._slice_starts = np.array([s for _, (s, _) in ordered], dtype=np.int64)
+        self._slice_docs = [doc_id for doc_id, _ in ordered]
+
+    def _lookup(self, vid: int) -> Optional[tuple[str, int]]:
+        """Map a vector id to (doc_id, chunk_index)."""
+        pos = int(np.searchsorted(self._slice_starts, vid, side="right")) - 1
+        if pos < 0:
+            return None
+        doc_id = self._slice_docs[pos]
+        start, count = self._doc_slices[doc_id]
+        if vid >= start + count:
+            return None
+        return doc_id, vid - start
+
+    def _all_ids(self) -> np.ndarray:
+        """Every live vector id."""
+        if not self._doc_slices:
+            return np.empty(0, dtype=np.int64)
+        return np.concatenate(
+            [np.arange(s, s + c, dtype=np.int64) for s, c in self._doc_slices.values()]
+        )
+
+    def _model_signature(self) -> str:
+        """Identify the model producing the stored vectors."""
+        if settings.embedding_backend == "onnx":
+            return f"{settings.embedding_model}:onnx:{settings.embedding_onnx_file}"
+        return f"{settings.embedding_model}:torch"
+
+    def _new_index(self) -> faiss.Index:
+        """Create an empty ID-mapped inner-product index over normalized embeddings."""
+        dim = self._model.get_sentence_embedding_dimension()
+        if settings.index_type == "hnsw":
+            base = faiss.IndexHNSWFlat(dim, settings.hnsw_m, faiss.METRIC_INNER_PRODUCT)
+            base.hnsw.efConstruction = settings.hnsw_ef_construction
+            base.hnsw.efSearch = settings.hnsw_ef_search
+        elif settings.index_type == "sq_fp16":
+            # Half-precision storage: half the memory and scan bandwidth of fp32
+            base = faiss.IndexScalarQuantizer(
+                dim, faiss.ScalarQuantizer.QT_fp16, faiss.METRIC_INNER_PRODUCT
+            )
+        else:
+            base = faiss.IndexFlatIP(dim)
+        return faiss.IndexIDMap2(base)
+
+    def _maybe_train_pq(self) -> None:
+        """Swap the exact index for a trained PQ index once enough vectors exist.
+
+        PQ codebooks need a sizeable training set, so a ``pq`` index starts flat
+        and is quantized the first time the corpus reaches ``pq_train_min``.
+        Training runs on a snapshot outside the lock; changes made meanwhile
+        are replayed onto the new index before it is swapped in.
+        """
+        with self._lock:
+            if settings.index_type != "pq" or self._index.ntotal < settings.pq_train_min:
+                return
+            if self._training or isinstance(faiss.downcast_index(self._index.index), faiss.IndexPQ):
+                return
+            self._training = True
+            ids = self._all_ids()
+            vectors = self._index.reconstruct_batch(ids)
+            snapshot_next_id = self._next_id
+
+        try:
+            pq = faiss.IndexPQ(
+                vectors.shape[1], settings.pq_m, settings.pq_nbits, faiss.METRIC_INNER_PRODUCT
+            )
+            pq.train(vectors)
+            index = faiss.IndexIDMap2(pq)
+            index.add_with_ids(vectors, ids)
+
+            with self._lock:
+                live = self._all_ids()
+                removed = np.setdiff1d(ids, live)
+                if len(removed):
+                    index.remove_ids(removed)
+                added = live[live >= snapshot_next_id]
+                if len(added):
+                    index.add_with_ids(self._index.reconstruct_batch(added), added)
+                self._index = index
+                self._dirty = True
+            print(f"Trained PQ index on {len(ids)} vectors")
+        finally:
+            self._training = False
+
+    def _apply_search_params(self) -> None:
+        """Re-apply runtime search parameters that are not persisted."""
+        base = faiss.downcast_index(self._index.index)
+        if isinstance(base, faiss.IndexHNSW):
+            base.hnsw.efSearch = settings.hnsw_ef_search
+
     def _load_index(self) -> None:
         """Load existing index if available."""
         index_path = self._get_index_path()
         map_path = self._get_map_path()
+        legacy_map_path = self._get_legacy_map_path()
 
         if index_path.exists() and map_path.exists():
-            self._index = faiss.read_index(str(index_path))
-            with open(map_path, "r") as f:
-                self._chunk_map = [tuple(item) for item in json.load(f)]
-            print(f"Loaded index with {self._index.ntotal} vectors")
+            with np.load(map_path) as data:
+                meta = json.loads(str(data["meta"]))
+                doc_ids = [str(d) for d in data["doc_ids"]]
+                starts = data["starts"].tolist()
+                counts = data["counts"].tolist()
+
+            if (
+                meta.get("version") == INDEX_VERSION
+                and meta.get("index_type") == settings.index_type
+                and meta.get("model") == self._model_signature()
+            ):
+                self._index = faiss.read_index(str(index_path))
+                self._apply_search_params()
+                self._set_slices(
+                    {d: (s, c) for d, s, c in zip(doc_ids, starts, counts)}
+                )
+                self._next_id = meta["next_id"]
+                print(f"Loaded index with {self._index.ntotal} vectors")
+                self._reconcile_with_chunk_store()
+            else:
+                self._rebuild_index(doc_ids)
+        elif legacy_map_path.exists():
+            # Pre-npz JSON maps: entries end with (doc_id, chunk_index)
+            with open(legacy_map_path, "r") as f:
+                data = json.load(f)
+            chunks = data["chunks"] if isinstance(data, dict) else data
+            self._rebuild_index(list(dict.fromkeys(item[-2] for item in chunks)))
+            legacy_map_path.unlink()
         else:
             # Create empty index
-            dim = self._model.get_sentence_embedding_dimension()
-            self._index = faiss.IndexFlatL2(dim)
-            self._chunk_map = []
+            self._index = self._new_index()
+            self._set_slices({})
+            self._next_id = 0
             print("Created new empty index")
+            self._reconcile_with_chunk_store()
+
+    def _reconcile_with_chunk_store(self) -> None:
+        """Catch up on document changes that never reached a saved index.
+
+        The chunk store commits immediately but the index is flushed every
+        ``index_save_interval`` seconds, so a crash in between can leave
+        documents stored but unindexed (or deleted but still indexed).
+        """
+        stored = set(chunk_store.get_doc_ids())
+        for doc_id in [d for d in self._doc_slices if d not in stored]:
+            self.remove_document(doc_id)
+        for doc_id in stored - self._doc_slices.keys():
+            print(f"Indexing document {doc_id} missing from the saved index")
+            self.add_document_chunks(doc_id, chunk_store.get_chunks(doc_id))
+        self.flush()
+
+    def _rebuild_index(self, doc_ids: list[str]) -> None:
+        """Re-embed the given documents' chunks from the chunk store into a fresh index."""
+        print("Index format is outdated, rebuilding from stored chunks")
+        self._index = self._new_index()
+        self._next_id = 0
+
+        texts = []
+        doc_slices: dict[str, tuple[int, int]] = {}
+        # Include stored documents the old index never picked up
+        for doc_id in dict.fromkeys([*doc_ids, *chunk_store.get_doc_ids()]):
+            chunks = chunk_store.get_chunks(doc_id)
+            if chunks:
+                doc_slices[doc_id] = (len(texts), len(chunks))
+                texts.extend(chunks)
+        self._set_slices(doc_slices)
+
+        if texts:
+            ids = np.arange(len(texts), dtype=np.int64)
+            self._index.add_with_ids(self.embed_texts(texts).astype(np.float32), ids)
+            self._next_id = len(texts)
+            self._maybe_train_pq()
 
-    def _save_index(self) -> None:
-        """Save index to disk."""
-        faiss.write_index(self._index, str(self._get_index_path()))
-        with open(self._get_map_path(), "w") as f:
-            json.dump(self._chunk_map, f)
+        self._save_index()
+        print(f"Rebuilt index with {self._index.ntotal} vectors")
 
-    def embed_text(self, text: str) -> np.ndarray:
-        """Embed a single text."""
-        return self._model.encode([text], convert_to_numpy=True)[0]
+    def _save_index(self) -> None:
+        """Save index to disk atomically via temp files."""
+        index_path = self._get_index_path()
+        map_path = self._get_map_path()
+        index_tmp = index_path.with_suffix(index_path.suffix + ".tmp")
+        map_tmp = map_path.with_suffix(map_path.suffix + ".tmp")
+
+        with self._save_lock:
+            # Snapshot under the lock (an in-memory copy), write to disk outside
+            # it so searches and uploads aren't held up by file I/O
+            with self._lock:
+                index_bytes = faiss.serialize_index(self._index)
+                doc_slices = dict(self._doc_slices)
+                next_id = self._next_id
+                self._dirty = False
+
+            meta = {
+                "version": INDEX_VERSION,
+                "index_type": settings.index_type,
+                "model": self._model_signature(),
+                "next_id": next_id,
+            }
+            doc_ids = list(doc_slices)
+            try:
+                with open(index_tmp, "wb") as f:
+                    f.write(index_bytes)
+                with open(map_tmp, "wb") as f:
+                    np.savez(
+                        f,
+                        meta=np.array(json.dumps(meta)),
+                        doc_ids=np.array(doc_ids, dtype=str),
+                        starts=np.array([doc_slices[d][0] for d in doc_ids], dtype=np.int64),
+                        counts=np.array([doc_slices[d][1] for d in doc_ids], dtype=np.int64),
+                    )
+                os.replace(index_tmp, index_path)
+                os.replace(map_tmp, map_path)
+            except Exception:
+                self._dirty = True  # Retry on the next flush
+                raise
+
+    def flush(self) -> None:
+        """Persist the index if it has unsaved changes."""
+        if self._dirty:
+            self._save_index()
+            print(f"Saved index with {self._index.ntotal} vectors")
+
+    async def run_autosave(self) -> None:
+        """Periodically flush unsaved index changes in the background."""
+        while True:
+            await asyncio.sleep(settings.index_save_interval)
+            if self._dirty:
+                await asyncio.to_thread(self.flush)
+
+    def embed_query(self, text: str) -> np.ndarray:
+        """Embed a search query as a read-only ``(1, d)`` float32 batch.
+
+        Read-only so the cached array can be shared safely between searches.
+        """
+        embedding = self._model.encode(
+            [text], convert_to_numpy=True, normalize_embeddings=True
+        ).astype(np.float32, copy=False)
+        embedding.setflags(write=False)
+        return embedding
 
     def embed_texts(self, texts: list[str]) -> np.ndarray:
-        """Embed multiple texts."""
-        return self._model.encode(texts, convert_to_numpy=True)
+        """Embed multiple texts.
+
+        Texts are encoded in length-sorted micro-batches to minimise padding,
+        then scattered back to the caller's order.
+        """
+        order = np.argsort([len(t) for t in texts], kind="stable")
+        embeddings = self._model.encode(
+            [texts[i] for i in order],
+            batch_size=settings.embedding_batch_size,
+            convert_to_numpy=True,
+            normalize_embeddings=True,
+            show_progress_bar=False,
+        )
+        inverse = np.empty_like(order)
+        inverse[order] = np.arange(len(order))
+        return embeddings[inverse]
 
     def add_document_chunks(
         self, doc_id: str, chunks: list[str]
@@ -71,63 +338,74 @@ class EmbeddingService:
 
         embeddings = self.embed_texts(chunks)
 
-        # Add to index
-        self._index.add(embeddings.astype(np.float32))
+        with self._lock:
+            # Add to index under a fresh, never-reused contiguous id range
+            start = self._next_id
+            ids = np.arange(start, start + len(chunks), dtype=np.int64)
+            self._index.add_with_ids(embeddings.astype(np.float32), ids)
+            self._next_id += len(chunks)
 
-        # Update chunk map
-        for i in range(len(chunks)):
-            self._chunk_map.append((doc_id, i))
+            self._set_slices({**self._doc_slices, doc_id: (start, len(chunks))})
+            self._dirty = True
 
-        self._save_index()
+        self._maybe_train_pq()
         print(f"Added {len(chunks)} chunks for document {doc_id}")
 
     def remove_document(self, doc_id: str) -> None:
-        """Remove document from index (requires rebuild)."""
-        # Find indices to keep
-        indices_to_keep = [
-            i for i, (did, _) in enumerate(self._chunk_map) if did != doc_id
-        ]
-
-        if len(indices_to_keep) == len(self._chunk_map):
-            return  # Document not in index
-
-        if not indices_to_keep:
-            # Reset to empty index
-            dim = self._model.get_sentence_embedding_dimension()
-            self._index = faiss.IndexFlatL2(dim)
-            self._chunk_map = []
-        else:
-            # Rebuild index with remaining vectors
-            all_vectors = faiss.rev_swig_ptr(
-                self._index.get_xb(), self._index.ntotal * self._index.d
-            ).reshape(self._index.ntotal, self._index.d)
-
-            kept_vectors = all_vectors[indices_to_keep]
-            dim = self._model.get_sentence_embedding_dimension()
-            new_index = faiss.IndexFlatL2(dim)
-            new_index.add(kept_vectors.astype(np.float32))
-
-            self._index = new_index
-            self._chunk_map = [self._chunk_map[i] for i in indices_to_keep]
-
-        self._save_index()
+        """Remove document from index by its vector id range."""
+        with self._lock:
+            if doc_id not in self._doc_slices:
+                return  # Document not in index
+
+            start, count = self._doc_slices[doc_id]
+            remaining = {d: s for d, s in self._doc_slices.items() if d != doc_id}
+
+            if settings.index_type == "hnsw":
+                # HNSW graphs cannot delete in place; rebuild from kept vectors
+                old_index = self._index
+                self._set_slices(remaining)
+                kept_ids = self._all_ids()
+                new_index = self._new_index()
+                if len(kept_ids):
+                    new_index.add_with_ids(old_index.reconstruct_batch(kept_ids), kept_ids)
+                self._index = new_index
+            else:
+                self._index.remove_ids(np.arange(start, start + count, dtype=np.int64))
+                self._set_slices(remaining)
+
+            self._dirty = True
         print(f"Removed document {doc_id} from index")
 
     def search(self, query: str, top_k: int = None) -> list[tuple[str, int, float]]:
-        """Search for similar chunks. Returns (doc_id, chunk_index, distance)."""
+        """Search for similar chunks. Returns (doc_id, chunk_index, distance).
+
+        The index scores by inner product; for unit vectors the squared L2
+        distance is recovered as ``2 - 2 * score``, so callers keep seeing
+        the same distance scale as before.
+        """
         top_k = top_k or settings.top_k
 
         if self._index.ntotal == 0:
             return []
 
-        query_embedding = self.embed_text(query).reshape(1, -1).astype(np.float32)
-        distances, indices = self._index.search(query_embedding, min(top_k, self._index.ntotal))
+        query_embedding = self._embed_query_cached(query)
 
+        # Reads must not overlap add/remove: add_with_ids may reallocate the
+        # index storage, and the slice columns are replaced one at a time
         results = []
-        for dist, idx in zip(distances[0], indices[0]):
-            if idx < len(self._chunk_map):
-                doc_id, chunk_idx = self._chunk_map[idx]
-                results.append((doc_id, chunk_idx, float(dist)))
+        with self._lock:
+            if self._index.ntotal == 0:
+                return []
+            scores, indices = self._index.search(
+                query_embedding, min(top_k, self._index.ntotal)
+            )
+            for score, vid in zip(scores[0], indices[0]):
+                if vid < 0:
+                    continue
+                match = self._lookup(int(vid))
+                if match:
+                    doc_id, chunk_idx = match
+                    results.append((doc_id, chunk_idx, max(0.0, 2.0 - 2.0 * float(score))))
 
         return results
 
@@ -138,10 +416,13 @@ class EmbeddingService:
 
 # Singleton instance - lazy loaded
 _embedding_service: Optional[EmbeddingService] = None
+_embedding_service_lock = threading.Lock()
 
 
 def get_embedding_service() -> EmbeddingService:
     global _embedding_service
     if _embedding_service is None:
-        _embedding_service = EmbeddingService()
+        with _embedding_service_lock:
+            if _embedding_service is None:
+                _embedding_service = EmbeddingService()
     return _embedding_service
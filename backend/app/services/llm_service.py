@@ -1,85 +1,147 @@
 import httpx
-import json
+import orjson
 from typing import AsyncIterator
 
 from app.config import settings
 
 
-class LLMService:
-    def __init__(self):
-        self.base_url = settings.ollama_base_url
-        self.model = settings.ollama_model
-
-    async def generate(self, prompt: str, context: str = "") -> str:
-        """Generate a response using Ollama."""
-        system_prompt = """You are a helpful assistant analyzing medical claims.
+# Kept byte-identical across calls: Ollama reuses the KV cache for a matching
+# prompt prefix, so the system prompt is only prefilled once per loaded model
+SYSTEM_PROMPT = """You are a helpful assistant analyzing medical claims.
 Use ONLY the provided context to answer questions. Be precise and accurate.
 When asked about claim status (approved, denied, pending), look at the "Status:" field in each claim.
 List all matching claims you find in the context. Do not make up or infer information."""
 
-        full_prompt = f"""Context:
+
+def build_prompt(prompt: str, context: str) -> str:
+    """Place the per-request context and question after the shared system prefix."""
+    return f"""Context:
 {context}
 
 Question: {prompt}
 
 Answer based on the context above:"""
 
-        async with httpx.AsyncClient(timeout=120.0) as client:
-            response = await client.post(
-                f"{self.base_url}/api/generate",
-                json={
-                    "model": self.model,
-                    "prompt": full_prompt,
-                    "system": system_prompt,
-                    "stream": False,
-                },
-            )
-            response.raise_for_status()
-            return response.json()["response"]
 
-    async def generate_stream(self, prompt: str, context: str = "") -> AsyncIterator[str]:
-        """Stream a response using Ollama."""
-        system_prompt = """You are a helpful assistant analyzing medical claims.
-Use ONLY the provided context to answer questions. Be precise and accurate.
-When asked about claim status (approved, denied, pending), look at the "Status:" field in each claim.
-List all matching claims you find in the context. Do not make up or infer information."""
+def create_ollama_client() -> httpx.AsyncClient:
+    """Create a pooled client so Ollama calls reuse keep-alive connections."""
+    return httpx.AsyncClient(
+        timeout=120.0,
+        limits=httpx.Limits(max_keepalive_connections=32, max_connections=64),
+    )
+
+
+def ollama_options() -> dict:
+    """Runtime options sent with every Ollama generation request."""
+    options = {"num_batch": settings.ollama_num_batch}
+    if settings.ollama_num_thread > 0:
+        options["num_thread"] = settings.ollama_num_thread
+    if settings.ollama_num_gpu >= 0:
+        options["num_gpu"] = settings.ollama_num_gpu
+    return options
+
+
+async def warmup_ollama_model(
+    client: httpx.AsyncClient, base_url: str, model: str, tag: str
+) -> bool:
+    """Ask Ollama to load a model now (a request with no prompt only loads it).
+
+    Sends the same runner options as real requests; Ollama reloads a model
+    whose options change, which would undo the warmup.
+    """
+    try:
+        response = await client.post(
+            f"{base_url}/api/generate",
+            json={
+                "model": model,
+                "options": ollama_options(),
+                "keep_alive": settings.ollama_keep_alive,
+            },
+        )
+        response.raise_for_status()
+        print(f"[{tag}] Prewarmed {model}")
+        return True
+    except Exception as e:
+        print(f"[{tag}] Prewarm of {model} failed: {e}")
+        return False
+
+
+async def aiter_ndjson(response: httpx.Response) -> AsyncIterator[dict]:
+    """Decode an Ollama NDJSON stream, splitting frames on raw bytes for orjson."""
+    buf = b""
+    async for chunk in response.aiter_bytes(chunk_size=8192):
+        buf += chunk
+        *lines, buf = buf.split(b"\n")
+        for line in lines:
+            if line:
+                yield orjson.loads(line)
+    if buf.strip():
+        yield orjson.loads(buf)
 
-        full_prompt = f"""Context:
-{context}
 
-Question: {prompt}
+class LLMService:
+    def __init__(self):
+        self.base_url = settings.ollama_base_url
+        self.model = settings.ollama_model
+        self._client = create_ollama_client()
 
-Answer based on the context above:"""
+    async def generate(self, prompt: str, context: str = "") -> str:
+        """Generate a response using Ollama."""
+        full_prompt = build_prompt(prompt, context)
+
+        response = await self._client.post(
+            f"{self.base_url}/api/generate",
+            json={
+                "model": self.model,
+                "prompt": full_prompt,
+                "system": SYSTEM_PROMPT,
+                "stream": False,
+                "options": ollama_options(),
+                "keep_alive": settings.ollama_keep_alive,
+            },
+        )
+        response.raise_for_status()
+        return response.json()["response"]
 
-        async with httpx.AsyncClient(timeout=120.0) as client:
-            async with client.stream(
-                "POST",
-                f"{self.base_url}/api/generate",
-                json={
-                    "model": self.model,
-                    "prompt": full_prompt,
-                    "system": system_prompt,
-                    "stream": True,
-                },
-            ) as response:
-                async for line in response.aiter_lines():
-                    if line:
-                        data = json.loads(line)
-                        if "response" in data:
-                            yield data["response"]
+    async def generate_stream(self, prompt: str, context: str = "") -> AsyncIterator[str]:
+        """Stream a response using Ollama."""
+        full_prompt = build_prompt(prompt, context)
+
+        async with self._client.stream(
+            "POST",
+            f"{self.base_url}/api/generate",
+            json={
+                "model": self.model,
+                "prompt": full_prompt,
+                "system": SYSTEM_PROMPT,
+                "stream": True,
+                "options": ollama_options(),
+                "keep_alive": settings.ollama_keep_alive,
+            },
+        ) as response:
+            async for data in aiter_ndjson(response):
+                if "response" in data:
+                    yield data["response"]
 
     async def health_check(self) -> bool:
         """Check if Ollama is running and model is available."""
         try:
-            async with httpx.AsyncClient(timeout=5.0) as client:
-                response = await client.get(f"{self.base_url}/api/tags")
-                if response.status_code == 200:
-                    models = response.json().get("models", [])
-                    return any(m["name"] == self.model for m in models)
-                return False
+            response = await self._client.get(f"{self.base_url}/api/tags", timeout=5.0)
+            if response.status_code == 200:
+                models = response.json().get("models", [])
+                return any(m["name"] == self.model for m in models)
+            return False
         except Exception:
             return False
 
+    async def warmup(self) -> bool:
+        """Load the model into Ollama ahead of the first request."""
+        return await warmup_ollama_model(self._client, self.base_url, self.model, "LLM")
+
+    async def aclose(self) -> None:
+        """Close pooled connections."""
+        await self._client.aclose()
+
 
 # Singleton
 _llm_service = None
@@ -0,0 +1,24 @@
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable
+
+from app.config import settings
+
+# CPU-bound model calls (chunking, embedding) share this bounded pool so
+# concurrent uploads can't oversubscribe cores, while the default executor
+# stays free for aiofiles and short blocking I/O
+_ml_executor = ThreadPoolExecutor(
+    max_workers=settings.ml_workers, thread_name_prefix="ml"
+)
+
+
+async def run_ml(func: Callable[..., Any], *args: Any) -> Any:
+    """Run a CPU-bound model call on the ML pool, off the event loop."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_ml_executor, functools.partial(func, *args))
+
+
+def shutdown_ml_executor() -> None:
+    """Stop the ML pool, dropping queued work."""
+    _ml_executor.shutdown(wait=False, cancel_futures=True)
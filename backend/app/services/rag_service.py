@@ -1,46 +1,38 @@
-import json
-import aiofiles
-from typing import Optional, AsyncIterator
+import asyncio
+from typing import AsyncIterator
 
 from app.config import settings
+from app.services import chunk_store
 from app.services.embedding_service import get_embedding_service
 from app.services.document_service import load_metadata
 from app.services.llm_service import get_llm_service
+from app.services.ml_executor import run_ml
 
-
-async def get_chunk_text(doc_id: str, chunk_index: int) -> Optional[str]:
-    """Get chunk text by doc_id and chunk_index."""
-    chunks_path = settings.documents_dir / f"{doc_id}_chunks.json"
-    if not chunks_path.exists():
-        return None
-
-    async with aiofiles.open(chunks_path, "r") as f:
-        content = await f.read()
-        chunks = json.loads(content)
-
-    if chunk_index >= len(chunks):
-        return None
-
-    return chunks[chunk_index]
+CONTEXT_SEP = "\n\n---\n\n"
+NO_MATCH_ANSWER = "No confidently relevant information found."
 
 
 async def retrieve(query: str, top_k: int = None) -> list[dict]:
     """Retrieve relevant chunks for a query."""
     top_k = top_k or settings.top_k
 
-    # Search for similar chunks
-    results = get_embedding_service().search(query, top_k)
+    # Search for similar chunks (query embedding + FAISS scan, off the event loop)
+    results = await run_ml(get_embedding_service().search, query, top_k)
 
     if not results:
         return []
 
-    # Get metadata for context
-    metadata = await load_metadata()
+    # Get metadata for context and fetch every hit's text (one lookup, off the
+    # event loop) concurrently
+    keys = [(doc_id, idx) for doc_id, idx, _ in results]
+    metadata, texts = await asyncio.gather(
+        load_metadata(), asyncio.to_thread(chunk_store.get_chunk_texts, keys)
+    )
 
     # Build response with chunk text
     retrieved = []
     for doc_id, chunk_idx, distance in results:
-        chunk_text = await get_chunk_text(doc_id, chunk_idx)
+        chunk_text = texts.get((doc_id, chunk_idx))
         if chunk_text:
             doc_meta = metadata.get(doc_id, {})
             retrieved.append({
@@ -58,9 +50,17 @@ def build_context(chunks: list[dict]) -> str:
     """Build context string from retrieved chunks."""
     if not chunks:
         return "No relevant documents found."
-    return "\n\n---\n\n".join(
-        f"[{c['filename']}]: {c['text']}" for c in chunks
-    )
+    # List comprehension, not a generator: join materializes a list anyway
+    return CONTEXT_SEP.join([f"[{c['filename']}]: {c['text']}" for c in chunks])
+
+
+def _should_skip_llm(chunks: list[dict], context: str) -> bool:
+    """Whether retrieval is too weak for an LLM call to be worth its latency."""
+    best = min(c["distance"] for c in chunks)
+    if best > settings.rag_llm_skip_distance or len(context) < settings.rag_llm_min_context:
+        print(f"[RAG] Skipping LLM (best distance {best:.3f}, context {len(context)} chars)")
+        return True
+    return False
 
 
 async def query_rag(query: str, top_k: int = None, use_llm: bool = True) -> dict:
@@ -75,6 +75,10 @@ async def query_rag(query: str, top_k: int = None, use_llm: bool = True) -> dict
     }
 
     if use_llm and chunks:
+        if _should_skip_llm(chunks, context):
+            result["answer"] = NO_MATCH_ANSWER
+            return result
+
         llm = get_llm_service()
         try:
             answer = await llm.generate(query, context)
@@ -101,6 +105,11 @@ async def query_rag_stream(query: str, top_k: int = None) -> AsyncIterator[dict]
 
     # Then stream the LLM answer
     if chunks:
+        if _should_skip_llm(chunks, context):
+            yield {"type": "token", "token": NO_MATCH_ANSWER}
+            yield {"type": "done"}
+            return
+
         llm = get_llm_service()
         try:
             async for token in llm.generate_stream(query, context):
@@ -114,3 +123,5 @@ async def query_rag_stream(query: str, top_k: int = None) -> AsyncIterator[dict]
                 "type": "error",
                 "error": str(e),
             }
+    else:
+        yield {"type": "done"}
@@ -1,9 +1,22 @@
+import re
+from collections import OrderedDict
 import httpx
-import json
+import orjson
 from typing import Literal
 from dataclasses import dataclass
 
 from app.config import settings
+from app.services.llm_service import create_ollama_client, ollama_options, warmup_ollama_model
+
+
+# Unambiguous keyword cues, mirroring the tool descriptions below. A message
+# matching exactly one of these is routed without calling the model.
+_SCREEN_RE = re.compile(
+    r"\b(screen|monitor|display|looking at|what do you see)\b", re.IGNORECASE
+)
+_DOCS_RE = re.compile(
+    r"\b(documents?|files?|docs|claims?|patient records?)\b", re.IGNORECASE
+)
 
 
 @dataclass
@@ -17,7 +30,8 @@ class RouterService:
 
     def __init__(self):
         self.base_url = settings.ollama_base_url
-        self.model = "functiongemma"
+        self.model = settings.router_model
+        self._client = create_ollama_client()
         self.tools = [
             {
                 "type": "function",
@@ -71,25 +85,60 @@ class RouterService:
                 }
             }
         ]
+        # Tool schemas never change; serialize them once and splice them in
+        self._tools_json = orjson.Fragment(orjson.dumps(self.tools))
+        # LRU of model decisions keyed by normalized input
+        self._cache: OrderedDict[str, RouteDecision] = OrderedDict()
+
+    def cache_clear(self) -> None:
+        """Forget cached routing decisions."""
+        self._cache.clear()
 
     async def route(self, user_input: str) -> RouteDecision:
         """Determine whether to analyze screen or query documents."""
+        # Fast path: obvious cases skip the FunctionGemma round-trip
+        wants_screen = bool(_SCREEN_RE.search(user_input))
+        wants_docs = bool(_DOCS_RE.search(user_input))
+        if wants_screen != wants_docs:
+            action = "analyze_screen" if wants_screen else "query_documents"
+            print(f"[Router] Keyword match: {action}")
+            return RouteDecision(action=action, question=user_input)
+
+        # Repeated inputs reuse the earlier model decision
+        key = " ".join(user_input.lower().split())
+        cached = self._cache.get(key)
+        if cached is not None:
+            self._cache.move_to_end(key)
+            print(f"[Router] Cached decision: {cached.action}")
+            return cached
+
+        decision = await self._route_with_model(user_input)
+        self._cache[key] = decision
+        if len(self._cache) > settings.router_cache_size:
+            self._cache.popitem(last=False)
+        return decision
+
+    async def _route_with_model(self, user_input: str) -> RouteDecision:
+        """Ask FunctionGemma which tool fits the input."""
         messages = [
             {"role": "user", "content": user_input}
         ]
 
-        async with httpx.AsyncClient(timeout=30.0) as client:
-            response = await client.post(
-                f"{self.base_url}/api/chat",
-                json={
-                    "model": self.model,
-                    "messages": messages,
-                    "tools": self.tools,
-                    "stream": False,
-                },
-            )
-            response.raise_for_status()
-            result = response.json()
+        response = await self._client.post(
+            f"{self.base_url}/api/chat",
+            content=orjson.dumps({
+                "model": self.model,
+                "messages": messages,
+                "tools": self._tools_json,
+                "stream": False,
+                "options": ollama_options(),
+                "keep_alive": settings.ollama_keep_alive,
+            }),
+            headers={"Content-Type": "application/json"},
+            timeout=30.0,
+        )
+        response.raise_for_status()
+        result = orjson.loads(response.content)
 
         message = result.get("message", {})
         tool_calls = message.get("tool_calls", [])
@@ -119,15 +168,26 @@ class RouterService:
     async def health_check(self) -> bool:
         """Check if FunctionGemma is available."""
         try:
-            async with httpx.AsyncClient(timeout=5.0) as client:
-                response = await client.get(f"{self.base_url}/api/tags")
-                if response.status_code == 200:
-                    models = response.json().get("models", [])
-                    return any(m["name"].startswith("functiongemma") for m in models)
-                return False
+            response = await self._client.get(f"{self.base_url}/api/tags", timeout=5.0)
+            if response.status_code == 200:
+                models = response.json().get("models", [])
+                # Accept any tag of the family when no tag is pinned
+                return any(
+                    m["name"] == self.model or m["name"].startswith(f"{self.model}:")
+                    for m in models
+                )
+            return False
         except Exception:
             return False
 
+    async def warmup(self) -> bool:
+        """Load the model into Ollama ahead of the first request."""
+        return await warmup_ollama_model(self._client, self.base_url, self.model, "Router")
+
+    async def aclose(self) -> None:
+        """Close pooled connections."""
+        await self._client.aclose()
+
 
 # Singleton
 _router_service = None
@@ -1,8 +1,62 @@
-import httpx
+import asyncio
+import io
 import base64
+import hashlib
+import orjson
+from collections import OrderedDict
 from typing import AsyncIterator
 
+from PIL import Image
+
 from app.config import settings
+from app.services.llm_service import aiter_ndjson, create_ollama_client, get_llm_service, ollama_options
+from app.services.ml_executor import run_ml
+
+
+SYSTEM_PROMPT = """You are a helpful assistant analyzing screen captures.
+Describe what you see clearly and concisely.
+If asked a specific question about the screen, focus your answer on that."""
+
+
+def _strip_data_url(image_base64: str) -> str:
+    """Drop a leading "data:...;base64," prefix; only the prefix is scanned."""
+    if image_base64.startswith("data:"):
+        return image_base64.partition(",")[2]
+    return image_base64
+
+
+def _decode_image(image_base64: str) -> bytes:
+    """Decode a base64 image, with or without a data URL prefix."""
+    return base64.b64decode(_strip_data_url(image_base64))
+
+
+def _encode_image(image_bytes: bytes) -> str:
+    """Downscale to the model's input size and encode as JPEG base64.
+
+    CPU-bound on multi-MB screenshots, so callers run it in a worker thread.
+    """
+    image = Image.open(io.BytesIO(image_bytes))
+    max_size = settings.vision_max_image_size
+    if max(image.size) <= max_size and image.format == "JPEG":
+        # Already small and compressed: send as-is rather than re-encode
+        return base64.b64encode(image_bytes).decode("ascii")
+
+    # JPEG: let libjpeg decode at a reduced scale first (DCT scaling)
+    image.draft("RGB", (max_size, max_size))
+    image.thumbnail((max_size, max_size), Image.Resampling.LANCZOS)
+    buf = io.BytesIO()
+    image.convert("RGB").save(buf, format="JPEG", quality=85)
+    return base64.b64encode(buf.getvalue()).decode("ascii")
+
+
+def _image_key(image_bytes: bytes, question: str) -> bytes:
+    """Content-addressed key for an (image, question) pair."""
+    return hashlib.blake2b(image_bytes, digest_size=16).digest() + question.encode()
+
+
+def _prepare_image(image_base64: str) -> str:
+    """Decode, downscale and re-encode a base64 image for Ollama."""
+    return _encode_image(_decode_image(image_base64))
 
 
 class VisionService:
@@ -10,62 +64,97 @@ class VisionService:
 
     def __init__(self):
         self.base_url = settings.ollama_base_url
-        self.model = settings.ollama_model  # gemma3:4b has vision
+        # Gemma 3 4B has vision: reuse the chat model so Ollama keeps one
+        # set of weights and one KV cache resident for both
+        self.model = get_llm_service().model
+        self._client = create_ollama_client()
+        # Request fields that never change between calls
+        self._static_payload = {
+            "model": self.model,
+            "system": SYSTEM_PROMPT,
+            "options": ollama_options(),
+            "keep_alive": settings.ollama_keep_alive,
+        }
+        # Ollama runs vision generations one image at a time; cap how many we
+        # queue on it so bursts don't pile up contexts and memory
+        self._semaphore = asyncio.Semaphore(settings.vision_max_concurrency)
+        # Identical requests already in flight share one generation
+        self._inflight: dict[bytes, asyncio.Task] = {}
+        # LRU of answers keyed by image content + question; repeated frames of
+        # an unchanged screen return without another generation
+        self._cache: OrderedDict[bytes, str] = OrderedDict()
+
+    def _build_payload(self, question: str, image_base64: str, stream: bool) -> bytes:
+        """Serialized Ollama /api/generate request body for one image."""
+        # orjson rather than httpx's stdlib json: the base64 image dominates
+        return orjson.dumps({
+            **self._static_payload,
+            "prompt": question,
+            "images": [image_base64],
+            "stream": stream,
+        })
 
     async def analyze(self, image_base64: str, question: str = "What do you see in this image?") -> str:
-        """Analyze an image and answer a question about it."""
-
-        # Remove data URL prefix if present
-        if "," in image_base64:
-            image_base64 = image_base64.split(",")[1]
-
-        system_prompt = """You are a helpful assistant analyzing screen captures.
-Describe what you see clearly and concisely.
-If asked a specific question about the screen, focus your answer on that."""
-
-        async with httpx.AsyncClient(timeout=120.0) as client:
-            response = await client.post(
+        """Analyze a base64 (or data URL) image and answer a question about it."""
+        image_bytes = await run_ml(_decode_image, image_base64)
+        return await self.analyze_bytes(image_bytes, question)
+
+    async def analyze_bytes(self, image_bytes: bytes, question: str = "What do you see in this image?") -> str:
+        """Analyze raw image bytes and answer a question about it."""
+        key = await run_ml(_image_key, image_bytes, question)
+        cached = self._cache.get(key)
+        if cached is not None:
+            self._cache.move_to_end(key)
+            print("[Vision] Cached answer")
+            return cached
+
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.create_task(self._analyze_bytes(key, image_bytes, question))
+            self._inflight[key] = task
+            task.add_done_callback(lambda _: self._inflight.pop(key, None))
+        # Shield so one caller disconnecting doesn't cancel the others' result
+        return await asyncio.shield(task)
+
+    def cache_clear(self) -> None:
+        """Forget cached answers."""
+        self._cache.clear()
+
+    async def _analyze_bytes(self, key: bytes, image_bytes: bytes, question: str) -> str:
+        image_base64 = await run_ml(_encode_image, image_bytes)
+
+        async with self._semaphore:
+            response = await self._client.post(
                 f"{self.base_url}/api/generate",
-                json={
-                    "model": self.model,
-                    "prompt": question,
-                    "system": system_prompt,
-                    "images": [image_base64],
-                    "stream": False,
-                },
+                content=self._build_payload(question, image_base64, stream=False),
+                headers={"Content-Type": "application/json"},
             )
-            response.raise_for_status()
-            return response.json()["response"]
+        response.raise_for_status()
+        answer = orjson.loads(response.content)["response"]
+
+        self._cache[key] = answer
+        if len(self._cache) > settings.vision_cache_size:
+            self._cache.popitem(last=False)
+        return answer
 
     async def analyze_stream(self, image_base64: str, question: str = "What do you see in this image?") -> AsyncIterator[str]:
         """Stream analysis of an image."""
 
-        # Remove data URL prefix if present
-        if "," in image_base64:
-            image_base64 = image_base64.split(",")[1]
-
-        system_prompt = """You are a helpful assistant analyzing screen captures.
-Describe what you see clearly and concisely.
-If asked a specific question about the screen, focus your answer on that."""
-
-        async with httpx.AsyncClient(timeout=120.0) as client:
-            async with client.stream(
-                "POST",
-                f"{self.base_url}/api/generate",
-                json={
-                    "model": self.model,
-                    "prompt": question,
-                    "system": system_prompt,
-                    "images": [image_base64],
-                    "stream": True,
-                },
-            ) as response:
-                async for line in response.aiter_lines():
-                    if line:
-                        import json
-                        data = json.loads(line)
-                        if "response" in data:
-                            yield data["response"]
+        image_base64 = await run_ml(_prepare_image, image_base64)
+
+        async with self._semaphore, self._client.stream(
+            "POST",
+            f"{self.base_url}/api/generate",
+            content=self._build_payload(question, image_base64, stream=True),
+            headers={"Content-Type": "application/json"},
+        ) as response:
+            async for data in aiter_ndjson(response):
+                if "response" in data:
+                    yield data["response"]
+
+    async def aclose(self) -> None:
+        """Close pooled connections."""
+        await self._client.aclose()
 
 
 # Singleton
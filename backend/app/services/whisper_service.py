@@ -1,66 +1,172 @@
-import tempfile
+import asyncio
+import io
 import os
-from typing import Optional
+import threading
+import wave
+from concurrent.futures import ThreadPoolExecutor
+from typing import AsyncIterator, BinaryIO, Iterator, Optional, Union
+
+import numpy as np
 from faster_whisper import WhisperModel
 
 from app.config import settings
 
 
-class WhisperService:
-    _instance: Optional["WhisperService"] = None
-    _model: Optional[WhisperModel] = None
+# Whisper's native input rate
+SAMPLE_RATE = 16000
+
+# CTranslate2 already spreads one transcription over cpu_threads cores; a single
+# Python worker keeps concurrent requests from oversubscribing them
+_whisper_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="whisper")
+
+
+def _decode_pcm_wav(wav_bytes: bytes | bytearray) -> Optional[np.ndarray]:
+    """Decode 16 kHz 16-bit PCM WAV (what the frontend sends) straight to float32.
+
+    Returns None for anything else so the caller can fall back to PyAV.
+    """
+    try:
+        with wave.open(io.BytesIO(wav_bytes)) as wav:
+            if wav.getsampwidth() != 2 or wav.getframerate() != SAMPLE_RATE:
+                return None
+            channels = wav.getnchannels()
+            frames = wav.readframes(wav.getnframes())
+    except (wave.Error, EOFError):
+        return None
 
-    def __new__(cls):
-        if cls._instance is None:
-            cls._instance = super().__new__(cls)
-        return cls._instance
+    audio = np.frombuffer(frames, dtype="<i2").astype(np.float32) / 32768.0
+    if channels > 1:
+        audio = audio.reshape(-1, channels).mean(axis=1)
+    return audio
+
+
+def _wav_audio(wav_bytes: bytes | bytearray) -> Union[BinaryIO, np.ndarray]:
+    """Samples for PCM WAV; other formats/rates go to faster-whisper's in-memory decoder."""
+    audio = _decode_pcm_wav(wav_bytes)
+    return io.BytesIO(wav_bytes) if audio is None else audio
+
+
+class WhisperService:
+    """Speech-to-text with faster-whisper. Use get_whisper_service() for the shared instance."""
 
     def __init__(self):
-        if self._model is None:
-            print(f"Loading Whisper model: {settings.whisper_model}")
-            # Use CPU with int8 quantization for efficiency
-            self._model = WhisperModel(
-                settings.whisper_model,
-                device="cpu",
-                compute_type="int8",
+        print(f"Loading Whisper model: {settings.whisper_model}")
+        # Hyperthreads don't help CTranslate2's GEMMs; default to physical cores
+        cpu_threads = settings.whisper_cpu_threads or max(1, (os.cpu_count() or 2) // 2)
+        # English-only checkpoints can't transcribe anything else; never detect
+        if settings.whisper_model.endswith(".en"):
+            self._language = "en"
+        else:
+            self._language = settings.whisper_language or None
+        self._model = WhisperModel(
+            settings.whisper_model,
+            device=settings.whisper_device,
+            compute_type=settings.whisper_compute_type,
+            cpu_threads=cpu_threads,
+            num_workers=1,
+            local_files_only=settings.whisper_local_files_only,
+        )
+        print(
+            f"Whisper model loaded: {settings.whisper_model} "
+            # The type CTranslate2 resolved, not the requested "auto"
+            f"(compute_type={self._model.model.compute_type}, cpu_threads={cpu_threads}, "
+            f"language={self._language or 'auto'})"
+        )
+        if settings.prewarm_models:
+            self._warmup()
+
+    def _warmup(self) -> None:
+        """Run one dummy decode so kernel selection and allocations happen now."""
+        try:
+            # VAD off: it would drop the silent clip before the decoder runs
+            segments, _ = self._model.transcribe(
+                np.zeros(SAMPLE_RATE, dtype=np.float32),
+                language=self._language or "en",
+                beam_size=1,
+                vad_filter=False,
             )
-            print("Whisper model loaded")
+            list(segments)
+            print("Whisper model prewarmed")
+        except Exception as e:
+            print(f"Whisper prewarm failed: {e}")
 
     def transcribe_file(self, file_path: str) -> dict:
         """Transcribe audio file to text."""
-        segments, info = self._model.transcribe(
-            file_path,
-            language="en",
-            beam_size=5,
+        return self._transcribe(file_path)
+
+    def _run(self, audio: Union[str, BinaryIO, np.ndarray]):
+        """Start a lazy transcription; segments decode as they are iterated."""
+        return self._model.transcribe(
+            audio,
+            language=self._language,
+            beam_size=settings.whisper_beam_size,
+            best_of=1,
+            # A single temperature disables the re-decode fallback loop
+            temperature=0.0,
+            condition_on_previous_text=False,
+            # Recordings are mostly silence around a short command; only the
+            # detected speech goes through the decoder
+            vad_filter=settings.whisper_vad_filter,
+            vad_parameters={
+                "threshold": 0.5,
+                "min_silence_duration_ms": 500,
+                "speech_pad_ms": 200,
+            },
         )
 
-        # Collect all segments into full text
-        text = " ".join(segment.text.strip() for segment in segments)
+    def transcribe_stream(self, audio: Union[str, BinaryIO, np.ndarray]) -> Iterator[dict]:
+        """Yield each segment as soon as it is decoded."""
+        segments, _ = self._run(audio)
+        for segment in segments:
+            yield {"start": segment.start, "end": segment.end, "text": segment.text.strip()}
+
+    def _transcribe(self, audio: Union[str, BinaryIO, np.ndarray]) -> dict:
+        """Transcribe a path, file-like object or 16 kHz float32 samples."""
+        segments, info = self._run(audio)
+
+        # Collect all segments into full text, keeping their timestamps
+        segment_list = [
+            {"start": segment.start, "end": segment.end, "text": segment.text.strip()}
+            for segment in segments
+        ]
+        text = " ".join(segment["text"] for segment in segment_list)
 
         return {
             "text": text.strip(),
             "language": info.language,
+            "segments": segment_list,
         }
 
-    def transcribe_wav_bytes(self, wav_bytes: bytes) -> dict:
-        """Transcribe WAV file bytes."""
-        # Save to temp file and transcribe
-        with tempfile.NamedTemporaryFile(suffix=".wav", delete=False) as f:
-            f.write(wav_bytes)
-            temp_path = f.name
+    def transcribe_wav_bytes(self, wav_bytes: bytes | bytearray) -> dict:
+        """Transcribe WAV file bytes without touching disk."""
+        return self._transcribe(_wav_audio(wav_bytes))
 
-        try:
-            return self.transcribe_file(temp_path)
-        finally:
-            os.unlink(temp_path)
+    def transcribe_wav_bytes_stream(self, wav_bytes: bytes | bytearray) -> Iterator[dict]:
+        """Stream segments of WAV file bytes without touching disk."""
+        return self.transcribe_stream(_wav_audio(wav_bytes))
+
+    async def atranscribe_wav_bytes(self, wav_bytes: bytes | bytearray) -> dict:
+        """transcribe_wav_bytes on the Whisper worker, off the event loop."""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(_whisper_executor, self.transcribe_wav_bytes, wav_bytes)
+
+    async def atranscribe_wav_bytes_stream(self, wav_bytes: bytes | bytearray) -> AsyncIterator[dict]:
+        """transcribe_wav_bytes_stream, decoding each segment on the Whisper worker."""
+        loop = asyncio.get_running_loop()
+        segments = self.transcribe_wav_bytes_stream(wav_bytes)
+        while (segment := await loop.run_in_executor(_whisper_executor, next, segments, None)) is not None:
+            yield segment
 
 
 # Singleton instance - lazy loaded
 _whisper_service: Optional[WhisperService] = None
+_whisper_service_lock = threading.Lock()
 
 
 def get_whisper_service() -> WhisperService:
     global _whisper_service
     if _whisper_service is None:
-        _whisper_service = WhisperService()
+        with _whisper_service_lock:
+            if _whisper_service is None:
+                _whisper_service = WhisperService()
     return _whisper_service